@@ -19,6 +19,8 @@
 
 from __future__ import absolute_import, division, print_function
 import os
+import sys
+from itertools import islice
 import logging
 import time
 from collections import Counter
@@ -35,7 +37,12 @@ import torchmetrics
 from torchvision import transforms as T
 import torch
 
-from cnocr.consts import MODEL_VERSION, ENCODER_CONFIGS, DECODER_CONFIGS
+from cnocr.consts import (
+    MODEL_VERSION,
+    ENCODER_CONFIGS,
+    DECODER_CONFIGS,
+    AVAILABLE_MODELS,
+)
 from cnocr.utils import (
     set_logger,
     load_model_params,
@@ -44,9 +51,10 @@ from cnocr.utils import (
     read_img,
     draw_ocr_results,
     read_charset,
+    get_trt_ort_providers,
 )
 from cnocr.data_utils.aug import NormalizeAug
-from cnocr.trainer import PlTrainer, resave_model, Metrics
+from cnocr.trainer import PlTrainer, resave_model, Metrics, use_half_inputs
 from cnocr import CnOcr, gen_model
 from cnocr.recognizer import Recognizer
 
@@ -105,6 +113,11 @@ def cli():
     help='导入的训练好的识别模型，作为模型初始值。'
     '优先级低于"--resume-from-checkpoint"，当传入"--resume-from-checkpoint"时，此传入失效。默认为 `None`',
 )
+@click.option(
+    "--auto-workers",
+    is_flag=True,
+    help="训练前先花约30秒测试不同的 `num_workers` 取值，使用其中最快的那个。默认为 `False`",
+)
 def train(
     rec_model_name,
     index_dir,
@@ -112,14 +125,22 @@ def train(
     finetuning,
     resume_from_checkpoint,
     pretrained_model_fp,
+    auto_workers,
 ):
     """训练识别模型"""
-    from cnocr.dataset import OcrDataModule
+    from cnocr.dataset import (
+        OcrDataModule,
+        find_best_num_workers,
+        physical_cpu_count,
+    )
 
     from cnocr.data_utils.transforms import (
         train_transform,
         ft_transform,
         test_transform,
+        light_train_transform,
+        gen_gpu_train_transform,
+        with_half_output,
     )
 
     check_model_name(rec_model_name)
@@ -142,19 +163,71 @@ def train(
     val_transform = test_transform
 
     train_config = json.load(open(train_config_fp))
+    if train_config.get('accelerator') == 'cpu':
+        # 计算线程与 DataLoader 的 worker 共享 CPU，避免线程过多互相争抢。
+        # interop 线程数只能在并行计算开始前设置
+        torch.set_num_threads(max((os.cpu_count() or 1) // 2, 1))
+        torch.set_num_interop_threads(1)
+
+    batch_transform = None
+    if finetuning:
+        train_transform = ft_transform
+    elif train_config.get('gpu_augment', False):
+        # 大部分数据增强放在 GPU 上按 batch 进行
+        train_transform = light_train_transform
+        batch_transform = gen_gpu_train_transform()
+
+    # 使用 GPU 做混合精度训练时，DataLoader 直接输出 float16 图片；CPU 上仍使用 float32
+    if use_half_inputs(train_config):
+        train_transform = with_half_output(train_transform)
+        val_transform = with_half_output(val_transform)
+
+    # worker 太多时会因为争抢 CPU 反而变慢；留出两个物理核给主进程和 pin_memory 线程
+    num_cores = physical_cpu_count()
+    max_num_workers = max(num_cores - 2, 1)
+    num_workers = min(train_config['num_workers'], max_num_workers)
+    # 使用 GPU 时默认开启 pin_memory，配合 non_blocking 的拷贝加快数据传输
+    pin_memory = train_config.get(
+        'pin_memory', train_config.get('accelerator') == 'gpu'
+    )
+    if pin_memory and num_workers > 0 and num_cores < 8:
+        logger.warning(
+            'only %d physical CPU cores are found, '
+            'using `pin_memory` with `num_workers` > 0 may saturate the CPU' % num_cores
+        )
 
     data_mod = OcrDataModule(
         index_dir=index_dir,
         vocab_fp=train_config['vocab_fp'],
         img_folder=train_config['img_folder'],
-        train_transforms=train_transform if not finetuning else ft_transform,
+        train_transforms=train_transform,
         val_transforms=val_transform,
         batch_size=train_config['batch_size'],
         train_bucket_size=train_config.get('train_bucket_size'),
-        num_workers=train_config['num_workers'],
-        pin_memory=train_config['pin_memory'],
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        persistent_workers=train_config.get('persistent_workers', True),
+        prefetch_factor=train_config.get('prefetch_factor', 4),
+        cache_dir=train_config.get('cache_dir'),
     )
     data_mod.setup('')
+    if auto_workers:
+        candidates = [n for n in (0, 1, 2, 4, 8) if n <= max_num_workers]
+        data_mod.num_workers = find_best_num_workers(
+            data_mod.train,
+            batch_size=data_mod.batch_size,
+            candidates=candidates,
+            pin_memory=data_mod.pin_memory,
+        )
+    logger.info(
+        'DataLoader: num_workers=%d, pin_memory=%s, persistent_workers=%s, prefetch_factor=%s'
+        % (
+            data_mod.num_workers,
+            data_mod.pin_memory,
+            data_mod.persistent_workers,
+            data_mod.prefetch_factor,
+        )
+    )
 
     # train_ds = data_mod.train
     # for i in range(min(100, len(train_ds))):
@@ -169,8 +242,11 @@ def train(
     # return
 
     trainer = PlTrainer(
-        train_config, ckpt_fn=['cnocr', 'v%s' % MODEL_VERSION, rec_model_name]
+        train_config,
+        ckpt_fn=['cnocr', 'v%s' % MODEL_VERSION, rec_model_name],
+        batch_transform=batch_transform,
     )
+    # channels-last 格式由 `WrapperLightningModule` 根据训练配置设置
     model = gen_model(rec_model_name, data_mod.vocab)
     logger.info(model)
 
@@ -182,6 +258,35 @@ def train(
     )
 
 
+@cli.command('prepare-cache')
+@click.option(
+    '-i',
+    '--index-dir',
+    type=str,
+    required=True,
+    help='索引文件所在的文件夹，会读取文件夹中的 train.tsv 和 dev.tsv 文件',
+)
+@click.option(
+    '--img-folder', type=str, default=None, help='图片所在文件夹，相对于索引文件中记录的图片位置',
+)
+@click.option(
+    '-o',
+    '--cache-dir',
+    type=str,
+    required=True,
+    help='缓存文件所在的文件夹。训练时在json配置文件中通过 `cache_dir` 指定此文件夹',
+)
+def prepare_cache(index_dir, img_folder, cache_dir):
+    """把训练和验证图片预先解码并resize后存入缓存文件，训练时直接读取，避免每个epoch重复解码"""
+    from cnocr.dataset_utils import prepare_cache as _prepare_cache
+
+    for fn in ('train.tsv', 'dev.tsv'):
+        out_dir = _prepare_cache(
+            Path(index_dir) / fn, cache_dir, img_folder=img_folder, mode='train'
+        )
+        logger.info('cached images of %s are saved to %s' % (fn, out_dir))
+
+
 def visualize_example(example, fp_prefix):
     if not os.path.exists(os.path.dirname(fp_prefix)):
         os.makedirs(os.path.dirname(fp_prefix))
@@ -241,7 +346,12 @@ def visualize_example(example, fp_prefix):
     type=str,
     default='cpu',
 )
-@click.option("-i", "--img-file-or-dir", required=True, help="输入图片的文件路径或者指定的文件夹")
+@click.option(
+    "-i",
+    "--img-file-or-dir",
+    required=True,
+    help="输入图片的文件路径或者指定的文件夹。取值为 `-` 时从标准输入逐行读取图片路径，模型会一直常驻内存",
+)
 @click.option(
     "-s",
     "--single-line",
@@ -257,6 +367,38 @@ def visualize_example(example, fp_prefix):
 @click.option(
     "--show-details", is_flag=True, default=False, help="是否打印识别结果详情。默认值为 `False`",
 )
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=16,
+    help="识别模型每个 batch 处理的图片（或检测出的文本框）数量。默认值为 `16`",
+)
+@click.option(
+    "--use-tensorrt",
+    is_flag=True,
+    default=False,
+    help="是否使用 TensorRT（FP16）运行识别模型，仅对 CnOCR 自己的 `onnx` 类型识别模型有效（PaddleOCR 的模型会忽略此参数），需安装 `onnxruntime-gpu` 和 TensorRT。"
+    "构建好的 engine 会缓存在 `~/.cnocr/engines` 中。默认值为 `False`",
+)
+@click.option(
+    "--trt-max-width",
+    type=int,
+    default=4096,
+    help="使用 TensorRT 时，识别模型支持的最大图片宽度（resize 到高度 32 之后），更宽的图片会报错。默认值为 `4096`",
+)
+@click.option(
+    "--quantize",
+    is_flag=True,
+    default=False,
+    help="是否把识别模型动态量化为 int8，仅对 `cpu` 上运行的 `pytorch` 类型的识别模型有效。"
+    "可以加快预测速度，但精度会略有下降（约 0.5%）。默认值为 `False`",
+)
+@click.option(
+    "--compile-model",
+    is_flag=True,
+    default=False,
+    help="是否使用 `torch.compile()` 编译识别模型，仅对 `pytorch` 类型的识别模型有效。默认值为 `False`",
+)
 @click.option(
     "--verbose", is_flag=True, default=False, help="是否打印详细日志信息。默认值为 `False`",
 )
@@ -274,6 +416,11 @@ def predict(
     draw_results_dir,
     draw_font_path,
     show_details,
+    batch_size,
+    use_tensorrt,
+    trt_max_width,
+    quantize,
+    compile_model,
     verbose,
 ):
     """模型预测""",
@@ -282,8 +429,11 @@ def predict(
     else:
         logger = set_logger(log_level=logging.INFO)
 
+    read_stdin = img_file_or_dir == '-'
     fp_list = []
-    if os.path.isfile(img_file_or_dir):
+    if read_stdin:
+        pass
+    elif os.path.isfile(img_file_or_dir):
         fp_list.append(img_file_or_dir)
     elif os.path.isdir(img_file_or_dir):
         fn_list = glob.glob1(img_file_or_dir, '*g')
@@ -292,9 +442,22 @@ def predict(
         raise ValueError(
             f'"{img_file_or_dir}" is not found, which must be a file or a directory'
         )
-    if len(fp_list) == 0:
+    if not read_stdin and len(fp_list) == 0:
         raise ValueError(f'No image is found from "{img_file_or_dir}".')
 
+    rec_more_configs = {'compile_model': compile_model, 'quantize': quantize}
+    if use_tensorrt:
+        rec_space = AVAILABLE_MODELS.get_space(rec_model_name, rec_model_backend)
+        if rec_model_backend == 'onnx' and rec_space == AVAILABLE_MODELS.CNOCR_SPACE:
+            # engine 的 profile 按 `--batch-size` 构建，识别时的 batch 不会超出范围
+            rec_more_configs['ort_providers'] = get_trt_ort_providers(
+                max_batch_size=batch_size, max_width=trt_max_width
+            )
+        else:
+            logger.warning(
+                '`--use-tensorrt` only works for onnx models of cnocr, '
+                f'ignored for {(rec_model_name, rec_model_backend)}'
+            )
     ocr = CnOcr(
         rec_model_name=rec_model_name,
         rec_model_backend=rec_model_backend,
@@ -302,18 +465,40 @@ def predict(
         det_model_name=det_model_name,
         det_model_backend=det_model_backend,
         rec_model_fp=pretrained_model_fp,
+        rec_more_configs=rec_more_configs,
         context=context,
         # det_more_configs={'rotated_bbox': False},
     )
-    ocr_func = ocr.ocr_for_single_line if single_line else ocr.ocr
-    ocr_kwargs = {}
-    if not single_line:
-        ocr_kwargs['resized_shape'] = det_resized_shape
+    if read_stdin:
+        # 模型常驻内存，避免被脚本反复调用时每次都重新加载模型
+        fp_list = _read_fps_from_stdin()
+
+    if single_line:
+        # 单行文字图片不需要检测，多张图片一起分 batch 识别。
+        # 每个 chunk 内的图片会先按宽度排序再分 batch，以减少 padding
+        chunk_size = 1 if read_stdin else 8 * batch_size
+        fp_iter = iter(fp_list)
+        while True:
+            chunk_fps = list(islice(fp_iter, chunk_size))
+            if not chunk_fps:
+                break
+            start_time = time.time()
+            outs = ocr.ocr_for_single_lines(chunk_fps, batch_size=batch_size)
+            time_cost = time.time() - start_time
+            for fp, res in zip(chunk_fps, outs):
+                logger.info('\n' + '=' * 10 + fp + '=' * 10)
+                logger.info(res if show_details else res['text'])
+            logger.info(
+                'time cost: %f, %f per image'
+                % (time_cost, time_cost / len(chunk_fps))
+            )
+        return
 
+    ocr_kwargs = {'resized_shape': det_resized_shape, 'rec_batch_size': batch_size}
     for fp in fp_list:
         start_time = time.time()
         logger.info('\n' + '=' * 10 + fp + '=' * 10)
-        res = ocr_func(
+        res = ocr.ocr(
             fp,
             **ocr_kwargs,
             # box_score_thresh=0.14,
@@ -324,10 +509,8 @@ def predict(
             logger.info(res)
         else:
             logger.info('\n'.join([line_res['text'] for line_res in res]))
-        if single_line:
-            res = [res]
 
-        if not single_line and draw_results_dir is not None:
+        if draw_results_dir is not None:
             if not os.path.isfile(draw_font_path):
                 logger.error(
                     'can not find the font file {}, so stop drawing ocr results'.format(
@@ -344,6 +527,17 @@ def predict(
                 )
 
 
+def _read_fps_from_stdin():
+    for line in sys.stdin:
+        fp = line.strip()
+        if not fp:
+            continue
+        if not os.path.isfile(fp):
+            logger.error(f'"{fp}" is not found')
+            continue
+        yield fp
+
+
 @cli.command('evaluate')
 @click.option(
     '-m',
@@ -17,8 +17,9 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import math
 import random
-from typing import Tuple
+from typing import Tuple, Optional, Sequence
 
 import torch
 import torchvision.transforms.functional as F
@@ -29,6 +30,34 @@ except:
 
 from ..utils import normalize_img_array
 
+
+def sample_crop_margins(
+    ori_len: int, max_margin: int, uniforms: Optional[Sequence[float]] = None
+) -> Tuple[int, int]:
+    """
+    随机生成两端各自要裁掉的长度，每端不超过 `max_margin`，且裁剪后至少保留 `max(ori_len * 0.5, 4)`。
+    直接在合法范围内采样，不需要拒绝采样。
+
+    Args:
+        ori_len (int): 原始长度（高度或宽度）
+        max_margin (int): 每端最多裁掉的长度
+        uniforms (Optional[Sequence[float]]): 预先生成的 3 个 [0, 1) 之间的随机数。
+            默认为 `None`，表示使用 `random.random()` 生成
+
+    Returns: tuple, (首端裁掉的长度, 尾端裁掉的长度)
+
+    """
+    max_total = min(2 * max_margin, ori_len - math.ceil(max(ori_len * 0.5, 4)))
+    if max_total <= 0:
+        return 0, 0
+    if uniforms is None:
+        uniforms = (random.random(), random.random(), random.random())
+    first = int(uniforms[0] * (min(max_margin, max_total) + 1))
+    second = int(uniforms[1] * (min(max_margin, max_total - first) + 1))
+    # 先采样的一端范围更大，随机交换两端，保证两端的分布一致
+    return (first, second) if uniforms[2] < 0.5 else (second, first)
+
+
 class FgBgFlipAug(object):
     """前景色背景色对调。
 
@@ -54,11 +83,12 @@ class NormalizeAug(object):
 
 
 class RandomStretchAug(object):
-    """对图片在宽度上做随机拉伸"""
+    """对图片在宽度上做随机拉伸，拉伸后的宽度不小于 `min_width`"""
 
-    def __init__(self, min_ratio=0.9, max_ratio=1.1):
+    def __init__(self, min_ratio=0.9, max_ratio=1.1, min_width=1):
         self.min_ratio = min_ratio
         self.max_ratio = max_ratio
+        self.min_width = min_width
 
     def __call__(self, img: torch.Tensor):
         """
@@ -70,7 +100,84 @@ class RandomStretchAug(object):
         new_w_ratio = self.min_ratio + random.random() * (
             self.max_ratio - self.min_ratio
         )
-        return F.resize(img, [h, int(w * new_w_ratio)])
+        return F.resize(img, [h, max(int(w * new_w_ratio), self.min_width)])
+
+
+class RandomMorphology(object):
+    """
+    对 [C, H, W] 的图片做膨胀（`erode=False`）或腐蚀（`erode=True`），
+    kernel 的高和宽从 `[scale[0], scale[1])` 中随机选取。与 `transforms.Dilation`/`transforms.Erosion` 对应。
+    """
+
+    def __init__(self, scale=(2, 3), erode=False):
+        self.scale = scale
+        self.erode = erode
+
+    def __call__(self, img: torch.Tensor):
+        """
+
+        :param img: [C, H, W]
+        :return:
+        """
+        high = max(self.scale[1], self.scale[0] + 1)
+        kh = random.randrange(self.scale[0], high)
+        kw = random.randrange(self.scale[0], high)
+        # 腐蚀即对取反后的图片做膨胀（取最大值）
+        out = img.to(torch.float32)
+        if self.erode:
+            out = -out
+        # 与 cv2 一样以 kernel 中心为锚点；边缘使用复制填充，不改变取最大值的结果
+        padding = [kw // 2, kh // 2, kw - 1 - kw // 2, kh - 1 - kh // 2]
+        out = F.pad(out, padding, padding_mode='edge')
+        out = torch.nn.functional.max_pool2d(out, (kh, kw), stride=1)
+        if self.erode:
+            out = -out
+        return out.to(img.dtype)
+
+
+class GaussianNoiseAug(object):
+    """对取值范围为 [0, 1] 的 float 图片添加高斯噪声，结果截断到 [0, 1]。与 `v2.GaussianNoise` 相同。"""
+
+    def __init__(self, sigma=0.1):
+        self.sigma = sigma
+
+    def __call__(self, img: torch.Tensor):
+        return (img + torch.randn_like(img) * self.sigma).clamp_(0.0, 1.0)
+
+
+class RandomTransparentOverlay(object):
+    """在 [C, H, W] 的图片上随机画一个半透明的矩形框，模仿标注笔的标注效果。与 `transforms.TransparentOverlay` 对应。"""
+
+    def __init__(self, max_height_ratio, max_width_ratio, alpha):
+        self.max_height_ratio = max_height_ratio
+        self.max_width_ratio = max_width_ratio
+        self.alpha = alpha
+
+    def __call__(self, img: torch.Tensor):
+        """
+
+        :param img: [C, H, W]
+        :return:
+        """
+        channels, height, width = img.shape
+        max_height = int(height * self.max_height_ratio)
+        max_width = int(width * self.max_width_ratio)
+        x = random.randrange(max(width - max_width, 1))
+        y = random.randrange(max(height - max_height, 1))
+        rect_width = random.randrange(max(max_width, 1))
+        rect_height = random.randrange(max(max_height, 1))
+        if min(rect_height, rect_width) < 2:
+            return img
+
+        color = torch.tensor(
+            [random.randrange(256) for _ in range(channels)], dtype=torch.float32
+        ).view(-1, 1, 1)
+        img = img.clone()
+        # 与 `cv2.rectangle` 一样包含右下角的点
+        roi = img[:, y : y + rect_height + 1, x : x + rect_width + 1]
+        blended = roi.to(torch.float32) * (1 - self.alpha) + color * self.alpha
+        roi.copy_(blended.round())
+        return img
 
 
 class RandomCrop(torch.nn.Module):
@@ -89,21 +196,9 @@ class RandomCrop(torch.nn.Module):
         Returns:
             tuple: params (i, j, h, w) to be passed to ``crop`` for random crop.
         """
-        while True:
-            h_top, h_bot = (
-                random.randint(0, self.crop_size[0]),
-                random.randint(0, self.crop_size[0]),
-            )
-            w_left, w_right = (
-                random.randint(0, self.crop_size[1]),
-                random.randint(0, self.crop_size[1]),
-            )
-            h = ori_h - h_top - h_bot
-            w = ori_w - w_left - w_right
-            if h < ori_h * 0.5 or w < ori_w * 0.5:
-                continue
-
-            return h_top, w_left, h, w
+        h_top, h_bot = sample_crop_margins(ori_h, self.crop_size[0])
+        w_left, w_right = sample_crop_margins(ori_w, self.crop_size[1])
+        return h_top, w_left, ori_h - h_top - h_bot, ori_w - w_left - w_right
 
     def forward(self, img):
         """
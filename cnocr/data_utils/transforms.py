@@ -16,6 +16,7 @@
 # KIND, either express or implied.  See the License for the
 # specific language governing permissions and limitations
 # under the License.
+import os
 import random
 import logging
 import traceback
@@ -23,6 +24,7 @@ import traceback
 import cv2
 import torch
 import numpy as np
+from torchvision.transforms import v2
 
 try:
     import albumentations as alb
@@ -30,8 +32,19 @@ try:
     from albumentations.core.transforms_interface import ImageOnlyTransform
 except ImportError:
     raise ImportError(f'Please install the dev version of cnocr by: `pip install cnocr[dev]`')
-
-from ..utils import normalize_img_array
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+from .aug import (
+    RandomCrop,
+    RandomStretchAug as TensorRandomStretchAug,
+    RandomMorphology,
+    RandomTransparentOverlay,
+    GaussianNoiseAug,
+    sample_crop_margins,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -138,30 +151,41 @@ class Bitmap(ImageOnlyTransform):
         return img
 
 
-class RandomStretchAug(alb.Resize):
+class RandomStretchAug(ImageOnlyTransform):
     """保持高度不变的情况下，对图像的宽度进行随机拉伸"""
+
+    # `BatchedRandomPipeline` 需要为此 transform 预先生成的随机数个数
+    num_random_params = 1
+
     def __init__(
         self, min_ratio=0.9, max_ratio=1.1, min_width=8, always_apply=False, p=1
     ):
-        super(RandomStretchAug, self).__init__(
-            height=0, width=0, always_apply=always_apply, p=p
-        )
+        super(RandomStretchAug, self).__init__(always_apply, p)
         self.min_width = min_width
         self.min_ratio = min_ratio
         self.max_ratio = max_ratio
 
-    def apply(self, img, **params):
+    def params_from_random(self, img, uniforms):
+        ratio = self.min_ratio + uniforms[0] * (self.max_ratio - self.min_ratio)
+        return {'ratio': ratio}
+
+    def get_params(self):
+        return self.params_from_random(None, (random.random(),))
+
+    def apply(self, img, ratio=1.0, **params):
         h, w = img.shape[:2]
-        new_w_ratio = self.min_ratio + random.random() * (
-            self.max_ratio - self.min_ratio
-        )
-        new_w = max(int(w * new_w_ratio), self.min_width)
-        return alb.Resize(height=h, width=new_w).apply(img)
+        new_w = max(int(w * ratio), self.min_width)
+        out = cv2.resize(img, (new_w, h), interpolation=cv2.INTER_LINEAR)
+        if img.ndim > out.ndim:
+            out = np.expand_dims(out, axis=-1)
+        return out
 
 
 class CustomRandomCrop(ImageOnlyTransform):
     """从图像的四个边缘随机裁剪"""
 
+    num_random_params = 6
+
     def __init__(self, crop_size, always_apply=False, p=1.0):
         """
         Initializes a new instance of the CustomRandomCrop class.
@@ -174,28 +198,20 @@ class CustomRandomCrop(ImageOnlyTransform):
         super(CustomRandomCrop, self).__init__(always_apply, p)
         self.crop_size = crop_size
 
-    def cal_params(self, img):
+    def cal_params(self, img, uniforms=None):
         ori_h, ori_w = img.shape[:2]
-        for _ in range(10):
-            h_top, h_bot = (
-                random.randint(0, self.crop_size[0]),
-                random.randint(0, self.crop_size[0]),
-            )
-            w_left, w_right = (
-                random.randint(0, self.crop_size[1]),
-                random.randint(0, self.crop_size[1]),
-            )
-            h = ori_h - h_top - h_bot
-            w = ori_w - w_left - w_right
-            if h < max(ori_h * 0.5, 4) or w < max(ori_w * 0.5, 4):
-                continue
-
-            return h_top, w_left, h, w
+        h_uniforms, w_uniforms = (
+            (None, None) if uniforms is None else (uniforms[:3], uniforms[3:])
+        )
+        h_top, h_bot = sample_crop_margins(ori_h, self.crop_size[0], h_uniforms)
+        w_left, w_right = sample_crop_margins(ori_w, self.crop_size[1], w_uniforms)
+        return h_top, w_left, ori_h - h_top - h_bot, ori_w - w_left - w_right
 
-        return 0, 0, ori_h, ori_w
+    def params_from_random(self, img, uniforms):
+        return {'crop_params': self.cal_params(img, uniforms)}
 
-    def apply(self, img, **params):
-        h_top, w_left, h, w = self.cal_params(img)
+    def apply(self, img, crop_params=None, **params):
+        h_top, w_left, h, w = crop_params or self.cal_params(img)
         out = cv2.resize(
             img[h_top : h_top + h, w_left : w_left + w], img.shape[:2][::-1]
         )
@@ -204,8 +220,35 @@ class CustomRandomCrop(ImageOnlyTransform):
         return out
 
 
+def _blend_rect(roi, color, alpha):
+    height, width, channels = roi.shape
+    for h in range(height):
+        for w in range(width):
+            for c in range(channels):
+                value = (1.0 - alpha) * roi[h, w, c] + alpha * color[c]
+                roi[h, w, c] = int(value + 0.5)
+
+
+def _numpy_blend_rect(roi, color, alpha):
+    blended = roi * np.float32(1.0 - alpha)
+    blended += color * np.float32(alpha)
+    roi[:] = np.rint(blended)
+
+
+if njit is not None:
+    _fused_blend_rect = njit(cache=True, fastmath=True)(_blend_rect)
+    # 预先编译；`roi` 是原图片的切片，所以这里也使用非连续的数组
+    _fused_blend_rect(
+        np.zeros((3, 3, 1), dtype=np.uint8)[:2, :2], np.zeros(1, dtype=np.float32), 0.5
+    )
+else:
+    _fused_blend_rect = _numpy_blend_rect
+
+
 class TransparentOverlay(ImageOnlyTransform):
-    """模仿标注笔的标注效果。"""
+    """模仿标注笔的标注效果。注意：会直接修改传入的图片。"""
+
+    num_random_params = 7
 
     def __init__(
         self, max_height_ratio, max_width_ratio, alpha, always_apply=False, p=1.0
@@ -218,24 +261,15 @@ class TransparentOverlay(ImageOnlyTransform):
     def apply(self, img, x=0, y=0, height=0, width=0, color=(0, 0, 0), **params):
         if min(height, width) < 2:
             return img
-        original_c = img.shape[2]
-
-        # 确保图片有四个通道（RGBA）
-        if img.shape[2] < 4:
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
 
-        # 创建一个与图片大小相同的覆盖层
-        overlay = img.copy()
-
-        # 在覆盖层上涂色
-        cv2.rectangle(overlay, (x, y), (x + width, y + height), color, -1)
-
-        # 结合覆盖层和原图片
-        img = cv2.addWeighted(overlay, self.alpha, img, 1 - self.alpha, 0)
-
-        # Convert the image back to the original number of channels
-        if original_c != img.shape[2]:
-            img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+        # 直接修改传入的图片，不再复制整张图片；只读的图片才复制
+        if not img.flags.writeable:
+            img = img.copy()
+        # 只在矩形区域内结合覆盖层和原图片（与 `cv2.rectangle` 一样包含右下角的点）
+        roi = img[y : y + height + 1, x : x + width + 1]
+        # 单通道图片只使用第一个颜色值；四通道图片的 alpha 通道使用 0
+        color = np.asarray((list(color) + [0])[: img.shape[2]], dtype=np.float32)
+        _fused_blend_rect(roi, color, float(self.alpha))
 
         return img
 
@@ -243,21 +277,34 @@ class TransparentOverlay(ImageOnlyTransform):
     def targets_as_params(self):
         return ['image']
 
-    def get_params_dependent_on_targets(self, params):
-        img = params['image']
+    def _param_highs(self, img):
         height, width, _ = img.shape
 
         # Compute the actual pixel values for the maximum height and width
         max_height = int(height * self.max_height_ratio)
         max_width = int(width * self.max_width_ratio)
+        return [
+            max(width - max_width, 1),
+            max(height - max_height, 1),
+            max(max_width, 1),
+            max(max_height, 1),
+            256,
+            256,
+            256,
+        ]
+
+    def params_from_random(self, img, uniforms):
+        values = (np.asarray(uniforms) * self._param_highs(img)).astype(int)
+        return self._to_params(values.tolist())
 
-        x = np.random.randint(0, max(width - max_width, 1))
-        y = np.random.randint(0, max(height - max_height, 1))
-        rect_width = np.random.randint(0, max(max_width, 1))
-        rect_height = np.random.randint(0, max(max_height, 1))
-
-        color = [np.random.randint(0, 256) for _ in range(3)]
+    def get_params_dependent_on_targets(self, params):
+        # 所有参数一次性采样
+        highs = self._param_highs(params['image'])
+        return self._to_params(np.random.randint(0, highs).tolist())
 
+    @staticmethod
+    def _to_params(values):
+        x, y, rect_width, rect_height, *color = values
         return {
             'x': x,
             'y': y,
@@ -278,14 +325,140 @@ class ToSingleChannelGray(ImageOnlyTransform):
             return img
 
 
+def _norm_hwc_to_chw(img, out, mean, inv_std):
+    height, width, channels = img.shape
+    for h in range(height):
+        for w in range(width):
+            for c in range(channels):
+                out[c, h, w] = (img[h, w, c] * (1.0 / 255) - mean[c]) * inv_std[c]
+
+
+def _numpy_norm_hwc_to_chw(img, out, mean, inv_std):
+    np.multiply(img.transpose((2, 0, 1)), 1.0 / 255, out=out)
+    out -= mean[:, None, None]
+    out *= inv_std[:, None, None]
+
+
+if njit is not None:
+    _fused_norm_hwc_to_chw = njit(cache=True, fastmath=True)(_norm_hwc_to_chw)
+    # 预先编译，避免第一个 batch 承担编译耗时
+    _fused_norm_hwc_to_chw(
+        np.zeros((2, 2, 1), dtype=np.uint8),
+        np.empty((1, 2, 2), dtype=np.float32),
+        np.zeros(1, dtype=np.float32),
+        np.ones(1, dtype=np.float32),
+    )
+else:
+    _fused_norm_hwc_to_chw = _numpy_norm_hwc_to_chw
+
+
 class CustomNormalize(ImageOnlyTransform):
-    def apply(self, img, **params):  # -> [H, W, 1]
-        return normalize_img_array(img)
+    """
+    rescale 到 [0, 1] 后按 `(img - mean) / std` 标准化，一次遍历中同时完成 [H, W, C] -> [C, H, W] 的转换。
+    默认参数下与 `normalize_img_array` 结果相同。安装了 `numba` 时使用编译后的 kernel。
+    """
+
+    def __init__(self, mean=0.0, std=1.0, always_apply=False, p=1.0):
+        super(CustomNormalize, self).__init__(always_apply, p)
+        self.mean = np.asarray(mean, dtype=np.float32).reshape(-1)
+        self.inv_std = 1.0 / np.asarray(std, dtype=np.float32).reshape(-1)
+
+    def apply(self, img, **params):  # -> [C, H, W]
+        if img.ndim == 2:
+            img = np.expand_dims(img, axis=-1)
+        height, width, channels = img.shape
+        mean = np.ascontiguousarray(np.broadcast_to(self.mean, (channels,)))
+        inv_std = np.ascontiguousarray(np.broadcast_to(self.inv_std, (channels,)))
+        out = np.empty((channels, height, width), dtype=np.float32)
+        _fused_norm_hwc_to_chw(img, out, mean, inv_std)
+        return out
+
+
+class FastCompose(object):
+    """
+    轻量版的 `alb.Compose`，仅支持 `image` 这一个 target。
+    构建时去掉 `p=0` 的 transform；每个 transform 先做一次随机判断，未命中时直接跳过，
+    不再进入 transform 内部计算参数（如 `TransparentOverlay.get_params_dependent_on_targets`）。
+    """
+
+    def __init__(self, transforms):
+        self.transforms = [
+            t for t in transforms if getattr(t, 'always_apply', False) or t.p > 0
+        ]
+
+    def __call__(self, *, image, **kwargs):
+        data = {'image': image, **kwargs}
+        for t in self.transforms:
+            if not getattr(t, 'always_apply', False) and random.random() >= t.p:
+                continue
+            data = t(force_apply=True, **data)
+        return data
+
+
+class BatchedRandomPipeline(FastCompose):
+    """
+    与 `FastCompose` 相同，但一次性为接下来的 `block_size` 个样本生成所有的随机数：
+    每个 transform 是否执行，以及定义了 `num_random_params` 的 transform（如 `RandomStretchAug`、
+    `CustomRandomCrop`、`TransparentOverlay`）的参数。每个样本只取其中一行，
+    避免逐个样本、逐个 transform 地调用 Python 的随机数函数。
+    默认的 `train_transform` 基于 `torchvision.transforms.v2`，所以只有精调（`ft_transform`）
+    和验证（`test_transform`）使用此类。
+    """
+
+    def __init__(self, transforms, block_size=256):
+        super(BatchedRandomPipeline, self).__init__(transforms)
+        self.block_size = block_size
+        self._offsets = []
+        num_cols = 0
+        for t in self.transforms:
+            self._offsets.append(num_cols)
+            num_cols += 1 + getattr(t, 'num_random_params', 0)
+        self.num_cols = num_cols
+        self._pid = None
+        self._rng = None
+        self._block = None
+        self._row_idx = 0
+
+    def _next_row(self):
+        if self._pid != os.getpid():
+            # DataLoader 的每个 worker 都有一份本对象的拷贝，需在各自的进程中重新初始化 rng，
+            # 否则不同 worker 会生成相同的参数。torch 会为每个 worker 设置不同的 `random` 种子
+            self._pid = os.getpid()
+            self._rng = np.random.default_rng(random.getrandbits(64))
+            self._block = None
+        if self._block is None or self._row_idx >= len(self._block):
+            self._block = self._rng.random((self.block_size, self.num_cols))
+            self._row_idx = 0
+        row = self._block[self._row_idx]
+        self._row_idx += 1
+        return row
+
+    def __call__(self, *, image, **kwargs):
+        row = self._next_row()
+        data = {'image': image, **kwargs}
+        for t, offset in zip(self.transforms, self._offsets):
+            if not getattr(t, 'always_apply', False) and row[offset] >= t.p:
+                continue
+            num_params = getattr(t, 'num_random_params', 0)
+            if num_params > 0:
+                uniforms = row[offset + 1 : offset + 1 + num_params]
+                params = t.params_from_random(data['image'], uniforms)
+                data['image'] = t.apply(data['image'], **params)
+            else:
+                data = t(force_apply=True, **data)
+        return data
 
 
 class TransformWrapper(object):
-    def __init__(self, transform):
+    def __init__(self, transform, output_chw: bool = False):
+        """
+        Args:
+            transform: albumentations 的 transform
+            output_chw (bool): `transform` 的输出是否已经是 [C, H, W] 格式（如最后一步为 `CustomNormalize`）。
+                为 `True` 时不再做转置。默认为 `False`
+        """
         self.transform = transform
+        self.output_chw = output_chw
 
     def __call__(self, ori_image: torch.Tensor) -> torch.Tensor:
         """
@@ -308,79 +481,141 @@ class TransformWrapper(object):
             logger.error(e)
             return ori_image.to(torch.float32)
 
+        if self.output_chw:
+            return torch.from_numpy(out)
+
         if image.ndim > out.ndim:
             out = np.expand_dims(out, axis=-1)
         out = torch.from_numpy(out.transpose((2, 0, 1)))  # to: [C, H, W]
         return out
 
 
-_train_alb_transform = alb.Compose(
+# `v2.JPEG` 和 `v2.GaussianNoise` 需要 torchvision>=0.20：版本较低时不做 JPEG 压缩，高斯噪声使用自己的实现
+if hasattr(v2, 'JPEG'):
+    _jpeg_transforms = [v2.RandomApply([v2.JPEG(quality=(90, 100))], p=0.3)]
+else:
+    logger.debug('`v2.JPEG` needs torchvision>=0.20, skipped in train_transform')
+    _jpeg_transforms = []
+_gaussian_noise = (
+    v2.GaussianNoise(sigma=0.04)
+    if hasattr(v2, 'GaussianNoise')
+    else GaussianNoiseAug(sigma=0.04)
+)
+
+# 几何变换需要逐张图片地在原始宽度上做，否则会把 batch 中的 padding 区域也变换进图片里，
+# 所以 `light_train_transform` 中也保留它们
+_geometric_transforms = [
+    v2.RandomApply(
+        [v2.RandomAffine(degrees=0, shear=(0, 3, -3, 0), fill=255)], p=0.03
+    ),
+    v2.RandomApply(
+        [
+            v2.RandomAffine(
+                degrees=2, translate=(0.04, 0.03), scale=(0.85, 1.03), fill=255
+            )
+        ],
+        p=0.03,
+    ),
+    v2.RandomApply([v2.RandomAffine(degrees=1, scale=(0.85, 1.0), fill=255)], p=0.1),
+    v2.RandomApply([v2.ElasticTransform(alpha=50.0, sigma=12.0, fill=255)], p=0.1),
+]
+
+# 直接作用于 [C, H, W] 的 uint8 tensor，省去与 numpy 之间的来回转换
+_train_v2_transform = v2.Compose(
     [
-        CustomRandomCrop((8, 10), p=0.8),
-        alb.OneOf([Erosion((2, 3)), Dilation((2, 3))], p=0.1),
-        TransparentOverlay(1.0, 0.1, alpha=0.4, p=0.2),  # 半透明的矩形框覆盖
-        alb.Affine(shear={"x": (0, 3), "y": (-3, 0)}, cval=(255, 255, 255), p=0.03),
-        alb.ShiftScaleRotate(
-            shift_limit_x=(0, 0.04),
-            shift_limit_y=(0, 0.03),
-            scale_limit=(-0.15, 0.03),
-            rotate_limit=2,
-            border_mode=0,
-            interpolation=2,
-            value=(255, 255, 255),
-            p=0.03,
+        v2.RandomApply([RandomCrop((8, 10))], p=0.8),
+        v2.RandomApply(
+            [
+                v2.RandomChoice(
+                    [RandomMorphology((2, 3), erode=True), RandomMorphology((2, 3))]
+                )
+            ],
+            p=0.1,
         ),
-        alb.GridDistortion(
-            distort_limit=0.05,
-            border_mode=0,
-            interpolation=2,
-            value=(255, 255, 255),
-            p=0.04,
+        # 半透明的矩形框覆盖
+        v2.RandomApply([RandomTransparentOverlay(1.0, 0.1, alpha=0.4)], p=0.2),
+        *_geometric_transforms,
+        v2.RandomApply([v2.ColorJitter(brightness=0.05, contrast=0.2)], p=0.1),
+        *_jpeg_transforms,
+        v2.RandomApply([v2.GaussianBlur(3)], p=0.1),
+        v2.RandomAdjustSharpness(2, p=0.3),
+        v2.RandomApply(
+            [TensorRandomStretchAug(min_ratio=0.5, max_ratio=1.5, min_width=8)], p=0.2
         ),
-        alb.Compose(
+        v2.RandomInvert(p=0.3),
+        v2.ToDtype(torch.float32, scale=True),  # 与 `normalize_img_array` 一致: img / 255
+        v2.RandomApply([_gaussian_noise], p=0.2),  # 只支持 float 类型
+    ]
+)
+
+train_transform = _train_v2_transform
+
+# 使用 GPU 做数据增强时，CPU 上只保留开销小的 transform、Kornia 中没有对应实现的 transform 和几何变换，
+# 颜色变换由 `gen_gpu_train_transform()` 在 GPU 上按 batch 完成
+_light_train_v2_transform = v2.Compose(
+    [
+        v2.RandomApply([RandomCrop((8, 10))], p=0.8),
+        v2.RandomApply(
             [
-                alb.Affine(
-                    translate_px=(0, 2), always_apply=True, cval=(255, 255, 255)
-                ),
-                alb.ElasticTransform(
-                    p=1,
-                    alpha=50,
-                    sigma=120 * 0.1,
-                    alpha_affine=0.1,  #120 * 0.01,
-                    border_mode=0,
-                    value=(255, 255, 255),
-                ),
+                v2.RandomChoice(
+                    [RandomMorphology((2, 3), erode=True), RandomMorphology((2, 3))]
+                )
             ],
             p=0.1,
         ),
-        alb.RandomBrightnessContrast(0.1, 0.1, True, p=0.1),
-        alb.ImageCompression(95, p=0.3),
-        alb.GaussNoise(20, p=0.2),
-        alb.GaussianBlur((3, 3), p=0.1),
-        alb.Emboss(p=0.3, alpha=(0.2, 0.5), strength=(0.2, 0.7)),
-        alb.OpticalDistortion(
-            always_apply=False,
-            p=0.2,
-            distort_limit=(-0.05, 0.05),
-            shift_limit=(-0.05, 0.05),
-            interpolation=0,
-            border_mode=0,
-            value=(0, 0, 0),
-            mask_value=None,
+        v2.RandomApply([RandomTransparentOverlay(1.0, 0.1, alpha=0.4)], p=0.2),
+        *_geometric_transforms,
+        v2.RandomApply(
+            [TensorRandomStretchAug(min_ratio=0.5, max_ratio=1.5, min_width=8)], p=0.2
         ),
-        # alb.Sharpen(always_apply=False, p=0.3, alpha=(0.2, 0.5), lightness=(0.5, 1.0)),
-        RandomStretchAug(min_ratio=0.5, max_ratio=1.5, p=0.2, always_apply=False),
-        alb.InvertImg(p=0.3),
-        ToSingleChannelGray(always_apply=True),
-        CustomNormalize(always_apply=True),
-        # alb.Normalize(0.456045, 0.224567, always_apply=True),
-        # ToTensorV2(),
+        v2.ToDtype(torch.float32, scale=True),
     ]
 )
 
-train_transform = TransformWrapper(_train_alb_transform)
+light_train_transform = _light_train_v2_transform
+
+
+def with_half_output(transform):
+    """
+    在 `transform` 的输出后再转为 float16，拷贝到 GPU 的数据量减半。
+    图片在 GPU 上会被 `WrapperLightningModule` 转回 float32。
+    """
+    return v2.Compose([transform, v2.ToDtype(torch.float16)])
+
+
+def gen_gpu_train_transform() -> torch.nn.Module:
+    """
+    生成在 GPU 上按 batch 执行的数据增强模块，需配合 `light_train_transform` 使用。
+    这里只包含逐像素的颜色变换；它们也会改变 padding 区域的取值，
+    所以调用方需要在变换后把 padding 区域重新置为 0（见 `WrapperLightningModule.on_after_batch_transfer()`）。
+
+    Returns: torch.nn.Module, 输入输出都为 [B, 1, H, W]，取值范围为 [0, 1] 的 float tensor
+
+    """
+    try:
+        import kornia.augmentation as K
+    except ImportError:
+        raise ImportError(f'Please install kornia by: `pip install kornia`')
+
+    # 与 `train_transform` 的顺序一致：先反色再加噪声，加噪声后截断到 [0, 1]
+    return torch.nn.Sequential(
+        K.AugmentationSequential(
+            K.ColorJiggle(brightness=0.05, contrast=0.2, p=0.1),
+            K.RandomSharpness(sharpness=0.5, p=0.3),
+            K.RandomInvert(p=0.3),
+            K.RandomGaussianNoise(std=0.04, p=0.2),
+            same_on_batch=False,
+        ),
+        _ClampUnit(),
+    )
+
+
+class _ClampUnit(torch.nn.Module):
+    def forward(self, x):
+        return x.clamp(0.0, 1.0)
+
 
-_ft_alb_transform = alb.Compose(
+_ft_alb_transform = BatchedRandomPipeline(
     [
         CustomRandomCrop((4, 4), p=0.8),
         alb.OneOf([Erosion((2, 3)), Dilation((2, 3))], p=0.1),
@@ -409,9 +644,9 @@ _ft_alb_transform = alb.Compose(
     ]
 )
 
-ft_transform = TransformWrapper(_ft_alb_transform)
+ft_transform = TransformWrapper(_ft_alb_transform, output_chw=True)
 
-_test_alb_transform = alb.Compose(
+_test_alb_transform = BatchedRandomPipeline(
     [
         CustomRandomCrop((6, 8), p=0.8),
         ToSingleChannelGray(always_apply=True),
@@ -420,4 +655,4 @@ _test_alb_transform = alb.Compose(
     ]
 )
 
-test_transform = TransformWrapper(_test_alb_transform)
+test_transform = TransformWrapper(_test_alb_transform, output_chw=True)
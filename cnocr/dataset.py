@@ -17,16 +17,39 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import logging
+import os
+import time
 from pathlib import Path
-from typing import Optional, Union, List, Tuple, Callable
+from typing import Optional, Union, List, Tuple, Callable, Sequence
 
+import cv2
 import numpy as np
 import pytorch_lightning as pt
 import torch
 from torch.utils.data import DataLoader, Dataset, Sampler
 
 from .utils import read_charset, read_tsv_file, read_img, resize_img, pad_img_seq
-from .dataset_utils import gen_dataset, collate_fn as hf_collate_fn
+from .dataset_utils import gen_dataset, OcrBatch, collate_fn as hf_collate_fn
+
+logger = logging.getLogger(__name__)
+
+
+def worker_init_fn(worker_id):
+    # DataLoader 已把每个 worker 的 torch 线程数设为 1，但 OpenCV 默认仍会使用所有核，
+    # 这里也限制为一个线程，避免 worker 之间以及与 pin_memory 线程争抢 CPU
+    cv2.setNumThreads(1)
+
+
+def physical_cpu_count() -> int:
+    """物理 CPU 核数；无法获取时使用逻辑核数的一半。"""
+    try:
+        import psutil
+
+        count = psutil.cpu_count(logical=False)
+    except ImportError:
+        count = None
+    return count or max((os.cpu_count() or 1) // 2, 1)
 
 
 class OcrDataset(Dataset):
@@ -99,7 +122,7 @@ def collate_fn(img_labels: List[Tuple[str, str]]):
 
     img_lengths = torch.tensor([img.size(2) for img in img_list])
     imgs = pad_img_seq(img_list)
-    return imgs, img_lengths, labels_list, label_lengths
+    return OcrBatch(imgs, img_lengths, labels_list, label_lengths)
 
 
 class OcrDataModule(pt.LightningDataModule):
@@ -114,6 +137,9 @@ class OcrDataModule(pt.LightningDataModule):
         train_bucket_size: Optional[int] = None,
         num_workers: int = 0,
         pin_memory: bool = False,
+        persistent_workers: bool = True,
+        prefetch_factor: Optional[int] = 4,
+        cache_dir: Union[str, Path, None] = None,
     ):
         super().__init__()
         self.vocab, self.letter2id = read_charset(vocab_fp)
@@ -122,6 +148,8 @@ class OcrDataModule(pt.LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
         self.train_bucket_size = train_bucket_size
 
         self.train_transforms = train_transforms
@@ -144,6 +172,7 @@ class OcrDataModule(pt.LightningDataModule):
             transforms=self.train_transforms,
             mode='train',
             num_workers=self.num_workers,
+            cache_dir=cache_dir,
         )
         self.val = gen_dataset(
             self.index_dir / 'dev.tsv',
@@ -151,6 +180,7 @@ class OcrDataModule(pt.LightningDataModule):
             transforms=self.val_transforms,
             mode='val',
             num_workers=self.num_workers,
+            cache_dir=cache_dir,
         )
 
     @property
@@ -160,6 +190,15 @@ class OcrDataModule(pt.LightningDataModule):
     def setup(self, stage: str):
         pass
 
+    def _loader_kwargs(self):
+        kwargs = {'num_workers': self.num_workers, 'pin_memory': self.pin_memory}
+        if self.num_workers > 0:
+            # 这两个参数只在使用子进程时有效
+            kwargs['persistent_workers'] = self.persistent_workers
+            kwargs['prefetch_factor'] = self.prefetch_factor
+            kwargs['worker_init_fn'] = worker_init_fn
+        return kwargs
+
     def train_dataloader(self):
         if self.train_bucket_size is not None and self.train_bucket_size > 0:
             sampler = BucketSampler(self.train, bucket_size=self.train_bucket_size)
@@ -173,8 +212,7 @@ class OcrDataModule(pt.LightningDataModule):
             sampler=sampler,
             shuffle=shuffle,
             collate_fn=hf_collate_fn,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._loader_kwargs(),
         )
 
     def val_dataloader(self):
@@ -183,9 +221,57 @@ class OcrDataModule(pt.LightningDataModule):
             batch_size=self.batch_size,
             shuffle=False,
             collate_fn=hf_collate_fn,
-            num_workers=self.num_workers,
-            pin_memory=self.pin_memory,
+            **self._loader_kwargs(),
         )
 
     def test_dataloader(self):
         return None
+
+
+def find_best_num_workers(
+    dataset: Dataset,
+    batch_size: int,
+    candidates: Sequence[int] = (0, 1, 2, 4, 8),
+    total_seconds: float = 30.0,
+    pin_memory: bool = False,
+) -> int:
+    """
+    依次使用 `candidates` 中的 `num_workers` 读取数据，返回每秒处理样本数最多的取值。
+
+    Args:
+        dataset (Dataset): 训练数据集
+        batch_size (int): batch size
+        candidates (Sequence[int]): 待尝试的 `num_workers` 取值
+        total_seconds (float): 所有取值总共使用的测试时间（秒）。默认为 `30.0`
+        pin_memory (bool): 是否使用 `pin_memory`
+
+    Returns: int, 最优的 `num_workers` 取值
+
+    """
+    seconds_per_candidate = total_seconds / len(candidates)
+    best_num_workers, best_speed = candidates[0], -1.0
+    for num_workers in candidates:
+        loader = DataLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            collate_fn=hf_collate_fn,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            worker_init_fn=worker_init_fn if num_workers > 0 else None,
+        )
+        # 从第一个 batch 之后开始计时，不计入子进程的启动时间
+        it = iter(loader)
+        next(it, None)
+        num_samples = 0
+        start_time = time.time()
+        for batch in it:
+            num_samples += len(batch.img_lengths)
+            if time.time() - start_time >= seconds_per_candidate:
+                break
+        speed = num_samples / max(time.time() - start_time, 1e-6)
+        logger.info('num_workers: %d, samples/s: %.2f' % (num_workers, speed))
+        if speed > best_speed:
+            best_num_workers, best_speed = num_workers, speed
+        del it, loader
+    return best_num_workers
@@ -19,12 +19,26 @@
 #
 # use datasets from https://github.com/huggingface/datasets
 
-from datasets import Dataset, Image
+import hashlib
+import logging
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Sequence, Union
+
+from tqdm import tqdm
+from PIL import Image as PILImage
+from datasets import Dataset, Features, Image, Value, Sequence as HFSequence
 import numpy as np
 import torch
+from torch.utils.data import Dataset as TorchDataset
 
 from .consts import IMG_STANDARD_HEIGHT
-from .utils import read_tsv_file, pad_img_seq
+from .utils import read_tsv_file, read_img, pad_img_seq
+
+logger = logging.getLogger(__name__)
+
+CACHE_IMAGES_FN = 'images.bin'
+CACHE_OFFSETS_FN = 'offsets.npy'
+CACHE_INDEX_HASH_FN = 'index.sha256'
 
 
 def preprocess(img):
@@ -41,9 +55,116 @@ def preprocess(img):
     return img.resize(target_w_h)
 
 
+def read_and_preprocess(img_fp: Union[str, Path]) -> PILImage.Image:
+    """使用 `read_img()` 解码图片（JPEG 使用 libjpeg-turbo），然后再 `preprocess()`。"""
+    return preprocess(PILImage.fromarray(read_img(img_fp).squeeze(-1)))
+
+
+def _index_file_hash(index_fp: Union[str, Path]) -> str:
+    with open(index_fp, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def is_valid_cache(
+    split_cache_dir: Union[str, Path], index_fp: Union[str, Path]
+) -> bool:
+    """缓存是否由当前的索引文件生成；索引文件被修改（即使行数不变）后缓存即失效。"""
+    hash_fp = Path(split_cache_dir) / CACHE_INDEX_HASH_FN
+    offsets_fp = Path(split_cache_dir) / CACHE_OFFSETS_FN
+    if not (hash_fp.exists() and offsets_fp.exists()):
+        return False
+    return hash_fp.read_text().strip() == _index_file_hash(index_fp)
+
+
+def prepare_cache(
+    index_fp: Union[str, Path],
+    cache_dir: Union[str, Path],
+    img_folder: Optional[str] = None,
+    mode: str = 'train',
+) -> Path:
+    """
+    Decodes all the images in the index file, resizes them to height `IMG_STANDARD_HEIGHT` (see `preprocess()`),
+    and stores them contiguously as raw uint8 bytes, so that training can read them from a memory-mapped file
+    instead of decoding them again in every epoch.
+
+    Args:
+        index_fp (str | Path): The file path to the index file.
+        cache_dir (str | Path): The root folder of the cache. Files are saved into the sub folder
+            named after the index file, e.g. `<cache_dir>/train/` for `train.tsv`.
+        img_folder (str, optional): The folder path for the images. Defaults to None.
+        mode (str, optional): The mode of the dataset (train, val, test, etc.). Defaults to 'train'.
+
+    Returns:
+        Path: The folder containing the cache files.
+    """
+    img_fp_list, _ = read_tsv_file(index_fp, '\t', img_folder, mode)
+    out_dir = Path(cache_dir) / Path(index_fp).stem
+    out_dir.mkdir(parents=True, exist_ok=True)
+    hash_fp = out_dir / CACHE_INDEX_HASH_FN
+    if hash_fp.exists():
+        hash_fp.unlink()
+
+    # images[offsets[i]: offsets[i + 1]] 即为第 i 张图片，shape: [IMG_STANDARD_HEIGHT, W]
+    offsets = np.zeros(len(img_fp_list) + 1, dtype=np.int64)
+    with open(out_dir / CACHE_IMAGES_FN, 'wb') as f:
+        for idx, img_fp in enumerate(tqdm(img_fp_list, desc=str(index_fp))):
+            img = np.asarray(read_and_preprocess(img_fp), dtype=np.uint8)
+            f.write(img.tobytes())
+            offsets[idx + 1] = offsets[idx] + img.size
+    np.save(out_dir / CACHE_OFFSETS_FN, offsets)
+    # 最后写入，中途失败时不会留下看起来有效的缓存
+    hash_fp.write_text(_index_file_hash(index_fp))
+    return out_dir
+
+
+class CachedDataset(TorchDataset):
+    """从 `prepare_cache()` 生成的缓存文件中读取图片的数据集，返回结果的格式与 `gen_dataset()` 一致。"""
+
+    def __init__(
+        self,
+        cache_dir: Union[str, Path],
+        labels_list: Optional[List[List[str]]],
+        indices: Sequence[int],
+        transforms=None,
+    ):
+        super().__init__()
+        self.cache_dir = Path(cache_dir)
+        self.offsets = np.load(self.cache_dir / CACHE_OFFSETS_FN)
+        self.labels_list = labels_list
+        self.indices = indices
+        self.transforms = transforms
+        # 在各个 worker 进程中第一次使用时才打开，避免 memmap 被序列化
+        self._images = None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        if self._images is None:
+            self._images = np.memmap(
+                self.cache_dir / CACHE_IMAGES_FN, dtype=np.uint8, mode='r'
+            )
+        idx = self.indices[item]
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        img = np.array(self._images[start:end]).reshape(1, IMG_STANDARD_HEIGHT, -1)
+        img = torch.from_numpy(img)  # [1, H, W]
+        if self.transforms is not None:
+            img = self.transforms(img)
+
+        example = {'transformed_image': img}
+        if self.labels_list is not None:
+            example['labels'] = self.labels_list[item]
+        return example
+
+
 def gen_dataset(
-    index_fp, img_folder=None, transforms=None, mode='train', num_workers=None
-) -> Dataset:
+    index_fp,
+    img_folder=None,
+    transforms=None,
+    mode='train',
+    num_workers=None,
+    cache_dir=None,
+) -> Union[Dataset, CachedDataset]:
     """
     Generates a dataset based on the provided index file path.
 
@@ -53,12 +174,16 @@ def gen_dataset(
         transforms (callable, optional): The transforms to apply to the images. Defaults to None.
         mode (str, optional): The mode of the dataset (train, val, test, etc.). Defaults to 'train'.
         num_workers (int, optional): The number of workers for data loading. Defaults to None.
+        cache_dir (str | Path, optional): The root folder of the cache generated by `prepare_cache()`.
+            If the cache for this index file exists, images are read from it instead of being decoded
+            from the image files. Defaults to None.
 
     Returns:
         Dataset: The generated dataset.
     """
     img_fp_list, labels_list = read_tsv_file(index_fp, '\t', img_folder, mode)
 
+    sorted_indices = list(range(len(img_fp_list)))
     if mode != 'test':
         # 根据 labels 的长度进行排序
         sorted_indices = sorted(
@@ -67,17 +192,30 @@ def gen_dataset(
         img_fp_list = [img_fp_list[i] for i in sorted_indices]
         labels_list = [labels_list[i] for i in sorted_indices]
 
-    dataset = Dataset.from_dict(
-        {'image': img_fp_list, 'labels': labels_list}
-    ).cast_column("image", Image())
+    if cache_dir is not None:
+        split_cache_dir = Path(cache_dir) / Path(index_fp).stem
+        if is_valid_cache(split_cache_dir, index_fp):
+            logger.info(f'use cached images in {split_cache_dir}')
+            return CachedDataset(
+                split_cache_dir, labels_list, sorted_indices, transforms=transforms
+            )
+        logger.warning(
+            f'no valid cache is found in {split_cache_dir}, decoding the image files instead'
+        )
+
+    dataset = Dataset.from_dict({'image': img_fp_list, 'labels': labels_list})
 
     def map_func(examples):
-        examples['image'] = [preprocess(img) for img in examples['image']]
+        examples['image'] = [read_and_preprocess(fp) for fp in examples['image']]
         return examples
 
     if num_workers <= 0:
         num_workers = None
-    dataset = dataset.map(map_func, batched=True, num_proc=num_workers)
+    # 图片路径在 map 中使用 `read_img()` 解码，而不是通过 `datasets.Image()` 使用 PIL 解码
+    features = Features({'image': Image(), 'labels': HFSequence(Value('string'))})
+    dataset = dataset.map(
+        map_func, batched=True, num_proc=num_workers, features=features
+    )
 
     if transforms is not None:
 
@@ -95,7 +233,19 @@ def gen_dataset(
     return dataset
 
 
-def collate_fn(examples):
+class OcrBatch(NamedTuple):
+    """
+    一个 batch 的训练数据。使用 NamedTuple 而不是普通的类，
+    这样 DataLoader 的 `pin_memory` 和 PyTorch Lightning 的 `non_blocking` 拷贝都能逐个字段地处理其中的 tensor。
+    """
+
+    images: torch.Tensor  # [B, 1, H, W_max]
+    img_lengths: torch.Tensor  # [B]
+    labels_list: Optional[List[List[str]]]
+    label_lengths: Optional[torch.Tensor]  # [B]
+
+
+def collate_fn(examples) -> OcrBatch:
     img_list = []
     labels_list = []
     for example in examples:
@@ -105,4 +255,4 @@ def collate_fn(examples):
     label_lengths = torch.tensor([len(labels) for labels in labels_list])
     img_lengths = torch.tensor([img.size(2) for img in img_list])
     imgs = pad_img_seq(img_list)
-    return imgs, img_lengths, labels_list, label_lengths
+    return OcrBatch(imgs, img_lengths, labels_list, label_lengths)
@@ -236,7 +236,8 @@ class OcrModel(nn.Module):
         return dict(out)
 
     def _decode(self, features_seq, input_lengths):
-        if not isinstance(self.decoder, (nn.LSTM, nn.GRU)):
+        # 动态量化后的 LSTM/GRU 不再是 `nn.LSTM`/`nn.GRU` 的实例，所以这里判断是否为 FC decoder
+        if isinstance(self.decoder, nn.Sequential):
             return self.decoder(features_seq)
 
         w = features_seq.shape[1]
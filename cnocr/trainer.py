@@ -127,11 +127,42 @@ class Metrics(object):
         return results
 
 
+def use_channels_last(config) -> bool:
+    """是否使用 channels-last 格式训练。默认只在 CPU 上使用，可通过配置中的 `channels_last` 指定。"""
+    return config.get('channels_last', config.get('accelerator') == 'cpu')
+
+
+def use_half_inputs(config) -> bool:
+    """
+    DataLoader 是否输出 float16 图片（见 `with_half_output()`）。
+    默认只在 GPU 上做 16 位混合精度训练时使用，可通过配置中的 `half_inputs` 指定。
+    """
+    return config.get(
+        'half_inputs',
+        config.get('accelerator') == 'gpu'
+        and str(config.get('precision', 32)) in ('16', '16-mixed'),
+    )
+
+
 class WrapperLightningModule(pl.LightningModule):
-    def __init__(self, config, model):
+    def __init__(self, config, model, batch_transform: Optional[nn.Module] = None):
         super().__init__()
         self.config = config
         self.model = model
+        # 训练时在 GPU 上对整个 batch 的图片做数据增强
+        self.batch_transform = batch_transform
+        # CPU 上训练 OCR 模型时默认使用 channels-last 格式。
+        # 模型和输入（见 `on_after_batch_transfer()`）的格式都在这里统一决定，保证两者一致
+        self.channels_last = use_channels_last(config) and not isinstance(
+            model, ImageClassifier
+        )
+        if self.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        # 见 `with_half_output()`：DataLoader 输出 float16 图片以减少拷贝的数据量，
+        # 拷贝到 GPU 后再转回 float32
+        self.half_inputs = use_half_inputs(config) and not isinstance(
+            model, ImageClassifier
+        )
         self._optimizer = get_optimizer(
             config['optimizer'],
             self.model,
@@ -167,6 +198,25 @@ class WrapperLightningModule(pl.LightningModule):
             # (['a', 'b', 'c'], ['d', 'e', 'f']) -> ['abc', 'def']
             return [''.join(_one) for _one in target]
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if self.half_inputs:
+            batch = batch._replace(images=batch.images.float())
+        if self.batch_transform is not None and self.trainer.training:
+            with torch.no_grad():
+                images = self.batch_transform(batch.images)
+                # 变换也改变了 padding 区域的取值，这里重新置为 0，与 `pad_img_seq()` 保持一致
+                padding_mask = (
+                    torch.arange(images.shape[-1], device=images.device)
+                    >= batch.img_lengths.to(images.device)[:, None]
+                )  # [B, W_max]
+                images = images.masked_fill(padding_mask[:, None, None, :], 0.0)
+                batch = batch._replace(images=images)
+        if self.channels_last:
+            batch = batch._replace(
+                images=batch.images.contiguous(memory_format=torch.channels_last)
+            )
+        return batch
+
     def training_step(self, batch, batch_idx):
         # print(f'train step, cal_loss before: ')
         res = self.model.calculate_loss(
@@ -258,8 +308,11 @@ class PlTrainer(object):
     封装 PyTorch Lightning 的训练器。
     """
 
-    def __init__(self, config, ckpt_fn=None):
+    def __init__(
+        self, config, ckpt_fn=None, batch_transform: Optional[nn.Module] = None
+    ):
         self.config = config
+        self.batch_transform = batch_transform
 
         wandb_logger = WandbLogger(project='CnOCR-Rec', save_dir='runs', log_model=True)
         lr_monitor = LearningRateMonitor(logging_interval='step')
@@ -330,10 +383,15 @@ class PlTrainer(object):
         self.config['steps_per_epoch'] = steps_per_epoch
         if resume_from_checkpoint is not None:
             pl_module = WrapperLightningModule.load_from_checkpoint(
-                resume_from_checkpoint, config=self.config, model=model
+                resume_from_checkpoint,
+                config=self.config,
+                model=model,
+                batch_transform=self.batch_transform,
             )
         else:
-            pl_module = WrapperLightningModule(self.config, model)
+            pl_module = WrapperLightningModule(
+                self.config, model, batch_transform=self.batch_transform
+            )
 
         self.pl_trainer.fit(
             pl_module,
@@ -19,6 +19,7 @@
 from __future__ import division, absolute_import, print_function
 
 import hashlib
+import inspect
 import os
 from pathlib import Path
 import logging
@@ -36,6 +37,7 @@ from torch import Tensor
 from torch.nn.utils.rnn import pad_sequence
 from torchvision.utils import save_image
 import torchvision.transforms.functional as F
+from torchvision.io import decode_jpeg, read_file, ImageReadMode
 
 from .consts import (
     ENCODER_CONFIGS,
@@ -49,6 +51,13 @@ logging.basicConfig(format=fmt)
 logging.captureWarnings(True)
 logger = logging.getLogger()
 
+# 旧版 torchvision 的 `decode_jpeg()` 没有 `apply_exif_orientation` 参数，此时 JPEG 也使用 OpenCV 读取
+_DECODE_JPEG_WITH_EXIF = (
+    'apply_exif_orientation' in inspect.signature(decode_jpeg).parameters
+)
+if not _DECODE_JPEG_WITH_EXIF:
+    logger.debug('`decode_jpeg()` ignores EXIF orientation, use OpenCV instead')
+
 
 def set_logger(log_file=None, log_level=logging.INFO, log_file_level=logging.NOTSET):
     """
@@ -127,6 +136,74 @@ def get_default_ort_providers():
     return providers
 
 
+def get_trt_ort_providers(
+    engine_cache_dir: Optional[Union[str, Path]] = None,
+    fp16: bool = True,
+    max_batch_size: int = 16,
+    max_width: int = 4096,
+) -> List[Union[str, Tuple[str, Dict[str, Any]]]]:
+    """
+    使用 ONNX 识别模型时，通过 `onnxruntime` 的 TensorRT Execution Provider 运行模型。
+    第一次运行时会为当前 GPU 构建 TensorRT engine（可能需要几分钟），之后直接读取缓存的 engine。
+
+    Args:
+        engine_cache_dir (Optional[Union[str, Path]]): TensorRT engine 的缓存目录。
+            默认为 `None`，表示使用 `<data_dir>/engines`，如 `~/.cnocr/engines`
+        fp16 (bool): 是否使用 FP16 精度。默认为 `True`
+        max_batch_size (int): engine 支持的最大 batch size，需不小于识别时使用的 batch size。默认为 `16`
+        max_width (int): engine 支持的最大图片宽度（resize 到高度 32 之后）。
+            更宽的图片会被 `Recognizer` 拒绝并报错。默认为 `4096`
+
+    Returns: 可传给 `Recognizer` 的 `ort_providers` 参数的 providers 列表
+
+    """
+    engine_cache_dir = engine_cache_dir or os.path.join(data_dir(), 'engines')
+    os.makedirs(engine_cache_dir, exist_ok=True)
+    opt_batch_size = min(8, max_batch_size)
+    height = IMG_STANDARD_HEIGHT
+    trt_options = {
+        'trt_fp16_enable': fp16,
+        'trt_engine_cache_enable': True,
+        'trt_engine_cache_path': str(engine_cache_dir),
+        # 输入的宽度是变化的，需要指定 dynamic shape 的范围
+        'trt_profile_min_shapes': f'x:1x1x{height}x8,input_lengths:1',
+        'trt_profile_opt_shapes': f'x:{opt_batch_size}x1x{height}x280,'
+        f'input_lengths:{opt_batch_size}',
+        'trt_profile_max_shapes': f'x:{max_batch_size}x1x{height}x{max_width},'
+        f'input_lengths:{max_batch_size}',
+    }
+    return [
+        ('TensorrtExecutionProvider', trt_options),
+        'CUDAExecutionProvider',
+        'CPUExecutionProvider',
+    ]
+
+
+def get_trt_max_input_shape(
+    ort_providers: Optional[List[Union[str, Tuple[str, Dict[str, Any]]]]]
+) -> Optional[Tuple[int, int]]:
+    """
+    从 `ort_providers` 中取出 TensorRT profile 所允许的最大输入。
+
+    Returns: `(max_batch_size, max_width)`；未使用 TensorRT 或未指定 profile 时返回 `None`
+
+    """
+    for provider in ort_providers or []:
+        if (
+            not isinstance(provider, (tuple, list))
+            or provider[0] != 'TensorrtExecutionProvider'
+        ):
+            continue
+        max_shapes = provider[1].get('trt_profile_max_shapes')
+        if not max_shapes:
+            return None
+        for item in max_shapes.split(','):
+            dims = item.rsplit(':', maxsplit=1)[-1].split('x')
+            if len(dims) == 4:  # 图片输入：[B, C, H, W]
+                return int(dims[0]), int(dims[3])
+    return None
+
+
 def to_numpy(tensor: torch.Tensor) -> np.ndarray:
     return (
         tensor.detach().cpu().numpy() if tensor.requires_grad else tensor.cpu().numpy()
@@ -272,6 +349,18 @@ def read_img(path: Union[str, Path], gray=True) -> np.ndarray:
         * when `gray==True`, return a gray image, with dim [height, width, 1], with values range from 0 to 255
         * when `gray==False`, return a color image, with dim [height, width, 3], with values range from 0 to 255
     """
+    if _DECODE_JPEG_WITH_EXIF and str(path).lower().endswith(('.jpg', '.jpeg')):
+        # torchvision 使用 libjpeg-turbo 解码 JPEG，比 OpenCV 自带的 libjpeg 更快
+        try:
+            img = decode_jpeg(
+                read_file(str(path)),
+                mode=ImageReadMode.GRAY if gray else ImageReadMode.RGB,
+                apply_exif_orientation=True,
+            )  # [C, H, W]
+            return np.ascontiguousarray(img.permute(1, 2, 0).numpy())
+        except (RuntimeError, OSError) as e:  # 文件读取或解码失败时使用 OpenCV 再试一次
+            logger.debug(f'failed to decode {path} with torchvision, use OpenCV: {e}')
+
     if gray:
         img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
         if img is None:
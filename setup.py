@@ -53,7 +53,15 @@ extras_require = {
     "ort-cpu": ["onnxruntime"],
     "ort-gpu": ["onnxruntime-gpu"],
     "serve": ["uvicorn[standard]", "fastapi", "python-multipart", "pydantic"],
-    "dev": ["albumentations", "pip-tools", "pytest", "datasets[vision]"],
+    "dev": [
+        "albumentations",
+        "kornia",
+        "numba",
+        "torchvision>=0.16.0",
+        "pip-tools",
+        "pytest",
+        "datasets[vision]",
+    ],
 }
 
 entry_points = """
@@ -135,6 +135,23 @@ def test_ocr(img_fp, expected):
     assert cal_score(pred, expected) >= 0.8
 
 
+def test_read_jpeg():
+    """torchvision 解码 JPEG 的结果与 OpenCV 保持一致。"""
+    import cv2
+
+    img_fp = os.path.join(example_dir, 'helloworld.jpg')
+    cv_gray = cv2.imread(img_fp, cv2.IMREAD_GRAYSCALE)[..., None]
+    cv_rgb = cv2.cvtColor(cv2.imread(img_fp), cv2.COLOR_BGR2RGB)
+    for gray, expected in ((True, cv_gray), (False, cv_rgb)):
+        img = read_img(img_fp, gray=gray)
+        assert img.shape == expected.shape
+        assert img.dtype == np.uint8
+        # 两者使用的 JPEG 解码器不同，允许个别像素值有少量差异
+        diff = np.abs(img.astype(np.int16) - expected.astype(np.int16))
+        assert diff.max() <= 8
+        assert diff.mean() < 1.0
+
+
 @pytest.mark.parametrize('img_fp, expected', CASES)
 def test_all_models(img_fp, expected):
     """测试各种模型是否可正常调用。"""
@@ -266,6 +283,24 @@ def test_onnx(img_fp, expected):
     assert abs(pt_preds['score'] - onnx_preds['score']) < 1e-5
 
 
+@pytest.mark.parametrize('img_fp, expected', SINGLE_LINE_CASES)
+def test_quantize(img_fp, expected):
+    img_fp = os.path.join(example_dir, img_fp)
+
+    ocr = CnOcr(
+        'densenet_lite_136-gru',
+        rec_model_backend='pytorch',
+        det_model_name='naive_det',
+        context='cpu',
+        rec_more_configs={'quantize': True},
+    )
+    start_time = time.time()
+    pred = ocr.ocr_for_single_line(img_fp)
+    end_time = time.time()
+    print(f'\nquantized pytorch time cost {end_time - start_time}', pred)
+    assert cal_score([pred], expected) >= 0.8
+
+
 @pytest.mark.parametrize('img_fp, expected', MULTIPLE_LINE_CASES)
 def test_det_rec(img_fp, expected):
     ocr = CnOcr()
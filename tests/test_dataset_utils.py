@@ -19,15 +19,22 @@
 
 import os
 import sys
+import shutil
 import logging
 
+import torch
 from torch.utils.data import DataLoader
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
 
 from cnocr.utils import set_logger
-from cnocr.dataset_utils import gen_dataset, collate_fn
+from cnocr.dataset_utils import (
+    gen_dataset,
+    collate_fn,
+    prepare_cache,
+    CachedDataset,
+)
 from cnocr.data_utils.transforms import train_transform, test_transform
 
 logger = set_logger(log_level=logging.INFO)
@@ -42,3 +49,36 @@ def test_gen_dataset():
     for batch in iter(dataloader):
         print(batch)
         break
+
+
+def test_cached_dataset(tmp_path):
+    index_fp = tmp_path / 'train.tsv'
+    shutil.copy('data/test/train.tsv', index_fp)
+    img_folder = 'docs/examples'
+    cache_dir = tmp_path / 'cache'
+    prepare_cache(index_fp, cache_dir, img_folder=img_folder, mode='train')
+
+    def gen(cache_dir=None):
+        return gen_dataset(
+            index_fp,
+            img_folder=img_folder,
+            transforms=lambda img: img,
+            mode='train',
+            num_workers=0,
+            cache_dir=cache_dir,
+        )
+
+    decoded_ds, cached_ds = gen(), gen(cache_dir)
+    assert isinstance(cached_ds, CachedDataset)
+    assert len(decoded_ds) == len(cached_ds)
+    for idx in range(len(decoded_ds)):
+        decoded, cached = decoded_ds[idx], cached_ds[idx]
+        assert decoded['labels'] == cached['labels']
+        assert torch.equal(decoded['transformed_image'], cached['transformed_image'])
+
+    # 行数不变但顺序改变后，缓存失效
+    with open(index_fp, encoding='utf-8') as f:
+        lines = f.read().strip('\n').split('\n')
+    with open(index_fp, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines[::-1]) + '\n')
+    assert not isinstance(gen(cache_dir), CachedDataset)
@@ -26,13 +26,24 @@ import albumentations as alb
 import matplotlib.pyplot as plt
 
 from cnocr import read_img
+from cnocr.utils import normalize_img_array
+from cnocr.data_utils.aug import sample_crop_margins
 from cnocr.data_utils.transforms import (
     Erosion,
     Dilation,
     CustomRandomCrop,
-    _train_alb_transform,
+    RandomStretchAug,
+    TransparentOverlay,
+    CustomNormalize,
+    BatchedRandomPipeline,
+    _fused_norm_hwc_to_chw,
+    _numpy_norm_hwc_to_chw,
+    _fused_blend_rect,
+    _numpy_blend_rect,
+    _train_v2_transform,
     TransformWrapper,
 )
+from torchvision.transforms import v2
 
 
 def test_custom_random_crop():
@@ -56,8 +67,77 @@ def test_custom_random_crop():
     plt.savefig("test_custom_random_crop.png")
 
 
-_train_alb_transform.transforms = _train_alb_transform.transforms[:-1]
-train_transform = TransformWrapper(_train_alb_transform)
+def test_sample_crop_margins():
+    for ori_len in (2, 4, 8, 9, 32, 280):
+        for _ in range(100):
+            first, second = sample_crop_margins(ori_len, 10)
+            assert 0 <= first <= 10 and 0 <= second <= 10
+            if first + second > 0:
+                assert ori_len - first - second >= max(ori_len * 0.5, 4)
+
+
+def test_custom_normalize():
+    img = np.random.randint(0, 256, (32, 100, 1), dtype=np.uint8)
+    expected = normalize_img_array(img).transpose((2, 0, 1))
+    mean, inv_std = np.zeros(1, dtype=np.float32), np.ones(1, dtype=np.float32)
+    # 安装了 numba 时两者不同，分别是编译后的 kernel 和 numpy 的实现
+    for norm_func in (_fused_norm_hwc_to_chw, _numpy_norm_hwc_to_chw):
+        out = np.empty((1, 32, 100), dtype=np.float32)
+        norm_func(img, out, mean, inv_std)
+        assert np.allclose(out, expected, atol=1e-6)
+
+    normalize = CustomNormalize(always_apply=True)
+    out = normalize(image=img)['image']
+    assert out.dtype == np.float32 and np.allclose(out, expected, atol=1e-6)
+    # 二维的输入
+    out = normalize(image=img[:, :, 0])['image']
+    assert out.shape == (1, 32, 100) and np.allclose(out, expected, atol=1e-6)
+
+    img = np.random.randint(0, 256, (32, 100, 3), dtype=np.uint8)
+    out = normalize(image=img)['image']
+    assert np.allclose(out, normalize_img_array(img).transpose((2, 0, 1)), atol=1e-6)
+
+
+def test_blend_rect():
+    alpha = 0.4
+    for channels in (1, 3, 4):
+        img = np.random.randint(0, 256, (32, 100, channels), dtype=np.uint8)
+        color = np.random.randint(0, 256, channels).astype(np.float32)
+        # 之前的实现：`cv2.addWeighted()` 结合覆盖层和原图片
+        roi = img[4:20, 10:60]
+        overlay = np.full_like(roi, color.astype(np.uint8))
+        expected = cv2.addWeighted(overlay, alpha, roi, 1 - alpha, 0)
+        expected = expected.reshape(roi.shape)
+
+        # 安装了 numba 时两者不同，分别是编译后的 kernel 和 numpy 的实现
+        for blend_func in (_fused_blend_rect, _numpy_blend_rect):
+            out = img.copy()
+            blend_func(out[4:20, 10:60], color, alpha)
+            assert np.array_equal(out[4:20, 10:60], expected)
+            # 矩形区域外的像素不变
+            out[4:20, 10:60] = img[4:20, 10:60]
+            assert np.array_equal(out, img)
+
+
+def test_batched_random_pipeline():
+    transform = BatchedRandomPipeline(
+        [
+            CustomRandomCrop((8, 10), p=0.8),
+            TransparentOverlay(1.0, 0.1, alpha=0.4, p=0.5),
+            RandomStretchAug(min_ratio=0.5, max_ratio=1.5, p=0.5),
+            CustomNormalize(always_apply=True),
+        ],
+        block_size=4,
+    )
+    image = np.random.randint(0, 256, (32, 100, 1), dtype=np.uint8)
+    for _ in range(10):
+        out = transform(image=image)['image']
+        assert out.dtype == np.float32
+        assert out.shape[:2] == (1, 32) and 50 <= out.shape[2] <= 150
+
+
+# 去掉最后的 `ToDtype` 和 `GaussianNoise`，输出 uint8 的图片以便保存
+train_transform = v2.Compose(_train_v2_transform.transforms[:-2])
 
 
 def transform_alot(transform, image_fp, out_fp):